@@ -1,16 +1,26 @@
-from pathlib import Path
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+from typing import List, Optional, Tuple
 
 import datetime
+import errno
+import functools
 import os
 import random
+import re
 import shutil
+import sys
+import time
 
 import download_session
 import logging_setup
 
 logger = logging_setup.setup_logger("Book Module")
 
+DOWNLOAD_BUFFER_SIZE = 256 * 1024  # Bytes copied per read/write when saving a download to disk
+EXISTS_CACHE_TTL = 1.0  # Seconds during which a file existence check is reused
+NUM_DOWNLOAD_THREADS = 8  # Number of chapters of a book downloaded concurrently
+
 
 LANGUAGE_TO_CODE = {"english": "en", "spanish": "es", "brazilian portuguese": "pt", "portuguese": "pt",
                     "chinese": "zh", "dutch": "nl", "esperanto": "eo", "filipino": "tg", "german": "de",
@@ -28,7 +38,35 @@ LANGUAGE_TO_CODE = {"english": "en", "spanish": "es", "brazilian portuguese": "p
                     "galician": "gl", "irish": "ga", "tagalog": "tl", "wikang tagalog": "tl", "yiddish": "yi",
                     "multilingual": "multi", "maori": "mi", "danish": "da", "romanian": "ro"}
 
-CODE_TO_LANGUAGE = {language: code for code, language in LANGUAGE_TO_CODE.items()}
+# Freeze the table with interned keys and values so lookups can compare by identity first
+LANGUAGE_TO_CODE = MappingProxyType({sys.intern(language): sys.intern(code)
+                                     for language, code in LANGUAGE_TO_CODE.items()})
+
+# When several names map to the same code, the first one listed is used as the canonical name
+CODE_TO_LANGUAGE = MappingProxyType({code: language
+                                     for language, code in reversed(list(LANGUAGE_TO_CODE.items()))})
+
+# Sizes as shown in LibriVox pages, e.g. "(123.4MB)", "1,2 GB" or a plain number of bytes
+_SIZE_RE = re.compile(r"\(?\s*([\d.,]+)\s*([KMGTPEZY]?)B?\s*\)?", re.I)
+_SIZE_MULT = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4, "P": 1024**5,
+              "E": 1024**6, "Z": 1024**7, "Y": 1024**8}
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_timedelta(text: str) -> datetime.timedelta:
+    """Parses a 00:00:00 string a into a timedelta object.
+
+    Durations repeat a lot across a catalog so the parsed values are memoized.
+    """
+    parts = text.split(":")  # Each part gets stripped on its own
+    if len(parts) == 3:
+        hours = parts[0].strip()
+        minutes = parts[1].strip()
+        seconds = parts[2].strip()
+        if hours.isdigit() and minutes.isdigit() and seconds.isdigit():
+            return datetime.timedelta(hours=int(hours), minutes=int(minutes), seconds=int(seconds))
+
+    return None
 
 
 class AudioBookFile:
@@ -38,9 +76,10 @@ class AudioBookFile:
     _download_url: str = None
     _download_dir: str = None
     _download_filename: str = None
-    _download_path: str = None
+    download_path: str = None  # Full path kept in sync with download_dir and download_filename
     _duration: datetime.timedelta = None
     _size: int = None  # Filesize in bytes
+    _exists_cache: Optional[Tuple[float, bool]] = None  # (monotonic timestamp, exists)
 
     @property
     def language_code(self) -> str:
@@ -53,19 +92,18 @@ class AudioBookFile:
     @property
     def language(self) -> str:
         """The language name in which the AudioFile is recorded in."""
-        if self.language_code in CODE_TO_LANGUAGE:
-            return CODE_TO_LANGUAGE[self.language_code]
-
-        return self.language_code
+        return CODE_TO_LANGUAGE.get(self.language_code, self.language_code)
 
     @language.setter
     def language(self, text_language):
         """Set the language code via a language name."""
-        language = text_language.strip().lower()
-        if language in LANGUAGE_TO_CODE:
-            self._language_code = LANGUAGE_TO_CODE[language]
-        else:
-            self._language_code = language[:2]
+        self._set_language_code(text_language)
+
+    def _set_language_code(self, text):
+        """Map a language name to its code, falling back to its first two letters."""
+        language = text.strip().lower()
+        code = LANGUAGE_TO_CODE.get(language)
+        self._language_code = code if code is not None else language[:2]
 
     @property
     def download_url(self) -> str:
@@ -94,7 +132,7 @@ class AudioBookFile:
         new_dir = new_dir.strip()
         self._ensure_dir_exists(new_dir)
 
-        if self._download_path and self.is_downloaded:
+        if self.download_path and self.is_downloaded:
             self._move_self_to(new_dir=new_dir)
 
         self._download_dir = new_dir
@@ -114,17 +152,12 @@ class AudioBookFile:
         """Updates the download filename and path of the AudioBookFile in storage."""
         new_name = new_name.strip()
 
-        if self._download_path and self.is_downloaded:
+        if self.download_path and self.is_downloaded:
             self._move_self_to(new_name=new_name)
 
         self._download_filename = new_name
         self._update_full_path()
 
-    @property
-    def download_path(self) -> str:
-        """Full download path that reflects the combination of download_dir and download_filename."""
-        return self._download_path
-
     @property
     def duration(self) -> datetime.timedelta:
         """The duration of the AudioFile recording in a timedelta object."""
@@ -154,36 +187,11 @@ class AudioBookFile:
     def size(self, new_size):
         """Takes filesize in either text with units or bytes in an integer."""
         if type(new_size) is str:
-            new_size = new_size.replace(" ", "").upper()
-            new_size = new_size.replace(")", "")
-            new_size = new_size.replace("(", "")
-            new_size = new_size.replace(",", ".")
-            new_size = new_size.replace("B", "").strip()
-            target_unit = None
-            multiplier = 1
-            is_bytes = False
-            try:
-                float(new_size)
-                target_unit = "B"
-                is_bytes = True
-            except Exception as e:
-                pass
-
-            if not is_bytes:
-                multiplier *= 1024
-                for unit in ["K", "M", "G", "T", "P", "E", "Z", "Y"]:
-                    if not target_unit and unit in new_size:
-                        target_unit = unit
-                        multiplier *= 1024
-                    # Reject double units
-                    elif target_unit and unit in new_size:
-                        target_unit = None
-                        break
-
-            if target_unit:
-                new_size = new_size.replace(target_unit, "").strip()
+            size_match = _SIZE_RE.fullmatch(new_size.strip())
+            if size_match:
+                number, unit = size_match.groups()
                 try:
-                    self._size = int(float(new_size) * multiplier)
+                    self._size = int(float(number.replace(",", ".")) * _SIZE_MULT[unit.upper()])
                 except Exception as e:
                     logger.error(f"Failed to set a size from \"{new_size}\"")
                     logger.error(e)
@@ -202,50 +210,55 @@ class AudioBookFile:
         """Return if the AudioFile has been downloaded to the current download_path location."""
         if not self.download_path:
             return False
-        return Path(self.download_path).exists()
+
+        now = time.monotonic()
+        if self._exists_cache and now - self._exists_cache[0] < EXISTS_CACHE_TTL:
+            return self._exists_cache[1]
+
+        exists = os.path.exists(self.download_path)
+        self._exists_cache = (now, exists)
+        return exists
+
+    def _invalidate_exists_cache(self):
+        """Force the next is_downloaded access to check the storage again."""
+        self._exists_cache = None
 
     def _ensure_dir_exists(self, directory):
-        """Create a directory for the target download."""
-        directory = directory.strip()
-        if not Path(directory).exists():
-            os.mkdir(directory)
+        """Create a directory for the target download. The caller is expected to strip it."""
+        os.makedirs(directory, exist_ok=True)
 
     def _move_self_to(self, new_dir=None, new_name=None):
         """Move the downloaded AudioFile into a location."""
-        if self.is_downloaded:
-            if new_dir and not new_name:
-                shutil.move(self._download_path, os.path.join(new_dir, self.download_filename))
-            elif new_name and not new_dir:
-                shutil.move(self._download_path, os.path.join(self.download_dir, new_name))
-            elif new_name and new_dir:
-                shutil.move(self._download_path, os.path.join(new_dir, new_name))
+        if self.is_downloaded and (new_dir or new_name):
+            self._invalidate_exists_cache()
+            destination = os.path.join(new_dir or self.download_dir, new_name or self.download_filename)
+            try:
+                # A rename is a single syscall when both paths are in the same filesystem
+                os.replace(self.download_path, destination)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                shutil.move(self.download_path, destination)
 
     def _update_full_path(self):
         """Keep a shorthand access to the full dir + filename representation."""
+        self._invalidate_exists_cache()
         if self.download_dir and self.download_filename:
-            self._download_path = os.path.join(self.download_dir,
-                                               self.download_filename)
+            download_dir = self.download_dir
+            separator = "" if download_dir.endswith(os.sep) else os.sep
+            self.download_path = download_dir + separator + self.download_filename
         else:
-            self._download_path = None
+            self.download_path = None
 
     def _text_to_timedelta(self, text: str) -> datetime.timedelta:
         """Parses a 00:00:00 string a into a timedelta object"""
-        parts = text.strip().split(":")
-        if len(parts) == 3:
-            hours = parts[0].strip()
-            minutes = parts[1].strip()
-            seconds = parts[2].strip()
-            if hours.isnumeric and minutes.isnumeric and seconds.isnumeric:
-                hours = int(hours)
-                minutes = int(minutes)
-                seconds = int(seconds)
-                return datetime.timedelta(hours=hours, minutes=minutes, seconds=seconds)
-
-        return None
+        return _parse_timedelta(text)
 
     def delete_file(self):
-        if self.is_downloaded():
+        self._invalidate_exists_cache()
+        if self.is_downloaded:
             os.remove(self.download_path)
+            self._invalidate_exists_cache()
 
     def __repr__(self):
         return (f"title: {self.title} author: {self.author} download URL: {self.download_url}  "
@@ -259,9 +272,10 @@ class Chapter(AudioBookFile):
 
     def __init__(self, book_reference):
         self.book = book_reference
-        # Copy our parent book download directory if set
+        # Copy our parent book download directory if set. The book's setter already stripped and
+        # created it, and a new chapter has no file to move, so the setter cascade is skipped
         if book_reference and book_reference.download_dir:
-            self.download_dir = book_reference.download_dir
+            self._download_dir = book_reference.download_dir
 
         if book_reference.language_code and not self.language_code:
             self.language_code = book_reference.language_code
@@ -286,17 +300,27 @@ class Chapter(AudioBookFile):
             raise Exception("A download URL has not been set.")
 
         if not self.is_downloaded or overwrite:
-            session = download_session.make_session()
+            session = download_session.get_session()
             try:
-                download_request = session.get(self.download_url, stream=True, timeout=120)
+                # Ask for the file as-is so the raw stream can be written without decoding
+                download_request = session.get(self.download_url, stream=True, timeout=120,
+                                               headers={"Accept-Encoding": "identity"})
                 if download_request.status_code == 200:
                     # Maybe we should assert 'Content-Type': 'audio/mpeg' here?
                     if not self.size:
                         self.size = int(download_request.headers["Content-Length"])
 
-                    with open(self.download_path, "wb") as local_file:
+                    with open(self.download_path, "wb", buffering=DOWNLOAD_BUFFER_SIZE) as local_file:
                         logger.info(f"Downloading {self.download_filename} to \"{self.download_dir}\"...")
-                        shutil.copyfileobj(download_request.raw, local_file)
+                        raw_stream = download_request.raw
+                        raw_stream.decode_content = False
+                        write = local_file.write
+                        while True:
+                            chunk = raw_stream.read(DOWNLOAD_BUFFER_SIZE)
+                            if not chunk:
+                                break
+                            write(chunk)
+                    self._invalidate_exists_cache()
 
             except Exception as e:
                 logger.error(f"Failed to download \"{self.download_filename}\" from \"{self.download_url}\"")
@@ -304,7 +328,7 @@ class Chapter(AudioBookFile):
                 self.delete_file()
 
             else:
-                if Path(self.download_path).exists():
+                if os.path.isfile(self.download_path):
                     return True
         else:
             logger.info(f"File \"{self.download_filename}\" exists, skipping re-downloading...")
@@ -313,8 +337,7 @@ class Chapter(AudioBookFile):
         return False
 
     def __repr__(self):
-        rep = super(Chapter, self).__repr__()
-        return (rep + f"Chap#:{self.number}  language_code:{self.language_code}  "
+        return (f"{super(Chapter, self).__repr__()}Chap#:{self.number}  language_code:{self.language_code}  "
                 f"reader:{self.reader_name} book:{self.book.title}  ")
 
 
@@ -335,22 +358,21 @@ class Book(AudioBookFile):
 
     def download(self):
         if self.chapters:
-            for chapter in self.chapters:
-                if chapter:
-                    chapter.download()
+            # Chapter downloads are network bound so threads can overlap them
+            with ThreadPoolExecutor(max_workers=NUM_DOWNLOAD_THREADS) as executor:
+                list(executor.map(Chapter.download, filter(None, self.chapters)))
 
     def __repr__(self):
-        return (f"\n\nBook title: {self.title}\nBook author: {self.author}\nBook URL: {self.url}\n" +
-                f"Book download URL: {self.download_url}\nBook size: {self.size}\n" +
-                f"Book chapter count: {len(self.chapters)}\n\n" +
+        return (f"\n\nBook title: {self.title}\nBook author: {self.author}\nBook URL: {self.url}\n"
+                f"Book download URL: {self.download_url}\nBook size: {self.size}\n"
+                f"Book chapter count: {len(self.chapters)}\n\n"
                 f"======================== Book Chapters ========================\n{self.chapters}\n\n\n")
 
 
-def fmt_size_bytes(num_bytes: int) -> str:
-    num_bytes = float(num_bytes)
-    for unit in ["B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB"]:
-        if abs(num_bytes) < 1024.0:
-            return "%3.1f%s" % (num_bytes, unit)
-        num_bytes = num_bytes / 1024.0
+SIZE_UNITS = ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")
 
-    return "%.1f%s" % (num_bytes, "YB")
+
+def fmt_size_bytes(num_bytes: int) -> str:
+    # Every unit is 2^10 times the previous one, so the bit length picks the unit directly
+    unit_idx = min(max(0, (abs(int(num_bytes)).bit_length() - 1) // 10), len(SIZE_UNITS) - 1)
+    return "%3.1f%s" % (num_bytes / (1 << (unit_idx * 10)), SIZE_UNITS[unit_idx])
@@ -6,6 +6,10 @@ set of categories (DIRTY_CATEGORIES). These categories are considered "dirty"
 because they are not "clean speech" (undistorted human speech without background
 noise).
 """
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import functools
 import internetarchive
 import math
 import os
@@ -16,6 +20,7 @@ import logging_setup
 logger = logging_setup.setup_logger("InternetArchive Module")
 
 NUM_FILES = 10
+NUM_THREADS = 8  # Number of concurrent item metadata requests
 DIRTY_CATEGORIES = ["music", "instrumental", "78rpm", "ambient", "noise", "drone"]
 """These weights determine how many files of each category we're going to get.
 They are based on empirically determined "importance" of each category.
@@ -26,24 +31,36 @@ we don't want to download a lot of files in these category.
 """
 CATEGORIES_WEIGHTS = [0.117, 0.315, 0.076, 0.38, 0.085, 0.03]
 VALID_EXTENSIONS = [".mp3", ".mp4", ".ogg", ".wav", ".aac", ".m4b"]
+_VALID_EXT_TUPLE = tuple(VALID_EXTENSIONS)  # str.endswith only takes a tuple of suffixes
 
 
 def is_valid_item(item_metadata):
-    # We want audio files
-    pass
+    """Return if the item has at least one file we can download as audio."""
+    return any(file.get("name", "").endswith(_VALID_EXT_TUPLE) for file in item_metadata.get("files", []))
+
+
+@functools.lru_cache(maxsize=4096)
+def _cached_get_item(item_id):
+    """Fetch an item's metadata once per identifier, as different queries can return the same item."""
+    return internetarchive.get_item(item_id, http_adapter_kwargs=download_session.get_http_parameters())
 
 
 def fetch_items_in_query(search_query, num_items):
+    # Only look at twice as many results as needed so the search doesn't paginate endlessly
+    candidate_ids = [result["identifier"] for result in
+                     islice(internetarchive.search_items(query=search_query), num_items * 2)]
+
+    # Each item's metadata is a separate request so fetch them concurrently, a batch of the
+    # still missing amount at a time
     items = []
-    for item in internetarchive.search_items(query=search_query):
-        if len(items) < num_items:
-            item_id = item["identifier"]
-            item = internetarchive.get_item(item_id, http_adapter_kwargs=download_session.get_http_parameters())
-            if item:
-                logger.info(f"Fetched item \"{item_id}\"")
-                items.append(item)
-        else:
-            break
+    with ThreadPoolExecutor(max_workers=NUM_THREADS) as executor:
+        while candidate_ids and len(items) < num_items:
+            batch_ids = candidate_ids[:num_items - len(items)]
+            candidate_ids = candidate_ids[len(batch_ids):]
+            for item_id, item in zip(batch_ids, executor.map(_cached_get_item, batch_ids)):
+                if item and is_valid_item(item.item_metadata):
+                    logger.info(f"Fetched item \"{item_id}\"")
+                    items.append(item)
     return items
 
 
@@ -53,18 +70,36 @@ def make_category_query(category):
     return f"mediatype:(audio) subject:{category}"
 
 
+def split_by_weights(total, weights):
+    """Split total into integer amounts proportional to weights that add up to exactly total.
+
+    Amounts are rounded down and the leftover units go to the largest fractional parts, the
+    earlier weight winning ties.
+    """
+    weights_sum = sum(weights)
+    exact_amounts = [w * total / weights_sum for w in weights]
+    amounts = [math.floor(amount) for amount in exact_amounts]
+    leftover = total - sum(amounts)
+    by_fraction = sorted(range(len(weights)), key=lambda idx: amounts[idx] - exact_amounts[idx])
+    for idx in by_fraction[:leftover]:
+        amounts[idx] += 1
+    return amounts
+
+
 def fetch_total_n_items(num_items, uniform_distribution=False):
     """Get num_items files from internet archive in our dirty categories list"""
     logger.info(f"Fetching info for {num_items} internetarchive items...")
     categories_weights = CATEGORIES_WEIGHTS
     if uniform_distribution:
-        categories_weights = [1/len(DIRTY_CATEGORIES) for x in range(len(DIRTY_CATEGORIES))]
+        categories_weights = [1.0] * len(DIRTY_CATEGORIES)
 
-    how_many_of_each_cat = [math.ceil(w * num_items) for w in categories_weights]
-    logger.info("  ".join([f"{cat}:{quant}" for cat, quant in zip(DIRTY_CATEGORIES, how_many_of_each_cat)]))
+    amount_per_category = list(zip(DIRTY_CATEGORIES, split_by_weights(num_items, categories_weights)))
+    logger.info("  ".join([f"{cat}:{quant}" for cat, quant in amount_per_category]))
 
     total_items = []
-    for amount, category in zip(how_many_of_each_cat, DIRTY_CATEGORIES):
+    for category, amount in amount_per_category:
+        if not amount:
+            continue
         query = make_category_query(category)
         try:
             total_items.extend(fetch_items_in_query(query, amount))
@@ -82,14 +117,12 @@ def download_n_files(destination_dir, num_files=NUM_FILES):
         file_name = None
         file_size = None
         for file in item.files:
-            for extension in VALID_EXTENSIONS:
-                if extension in file["name"]:
-                    # We only want to download one file per item so if there are multiple files
-                    # with a valid extension in an item, we'll only download the first file.
-                    file_name = file["name"]
-                    file_size = int(file["size"])
-                    break
-            if file_name:
+            name = file["name"]
+            if name.endswith(_VALID_EXT_TUPLE):
+                # We only want to download one file per item so if there are multiple files
+                # with a valid extension in an item, we'll only download the first file.
+                file_name = name
+                file_size = int(file["size"])
                 break
 
         if file_name:
@@ -6,12 +6,14 @@ with BeautifulSoup. It uses the "Browsing by Title" book catalog in librivox.org
 book metadata. It then stores the information of each book in book.Book objects.
 """
 from bs4 import BeautifulSoup
-from multiprocessing import Pool
+from bs4 import SoupStrainer
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
 
-import json
+import functools
 import logging
 import random
-import requests
+import re
 
 from book import Book
 from book import Chapter
@@ -21,18 +23,32 @@ import logging_setup
 
 logger = logging_setup.setup_logger("LibriVox Scraper")
 
+# lxml's C parser is several times faster than the pure Python one bundled with BeautifulSoup
+try:
+    import lxml
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
 
-NUM_PROCESSES = 1  # Number of processes to use for downloading
+# orjson decodes the response bytes directly, the stdlib json module also accepts bytes
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+
+NUM_THREADS = 16  # Number of concurrent requests to librivox.org
 MAX_KNOWN_PAGE = 445  # The last know page from the book catalog
+BOOK_PAGE_CACHE_SIZE = 16  # Number of downloaded book pages kept in memory
 
-MAGIC_HEADERS = {"Referer": "https://librivox.org/search",
-                 "Host": "librivox.org",
-                 "Accept": "*/*",
-                 "Connection": "keep-alive",
-                 "Accept-Language": "en-us",
-                 "Accept-Encoding": "br, gzip, deflate",
-                 "User-Agent": "",
-                 "X-Requested-With": "XMLHttpRequest"}
+MAGIC_HEADERS = MappingProxyType({"Referer": "https://librivox.org/search",
+                                  "Host": "librivox.org",
+                                  "Accept": "*/*",
+                                  "Connection": "keep-alive",
+                                  "Accept-Language": "en-us",
+                                  "Accept-Encoding": "br, gzip, deflate",
+                                  "User-Agent": "",
+                                  "X-Requested-With": "XMLHttpRequest"})
 
 USER_AGENTS = ["Mozilla/5.0 (Macintosh; Intel Mac OS X 10.7; rv:11.0) Gecko/20100101 Firefox/11.0",
                "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:22.0) Gecko/20100 101 Firefox/22.0",
@@ -44,15 +60,18 @@ USER_AGENTS = ["Mozilla/5.0 (Macintosh; Intel Mac OS X 10.7; rv:11.0) Gecko/2010
                ("Mozilla/5.0 (Macintosh; Intel Mac OS X 10_13) AppleWebKit/604.1.38 (KHTML, like Gecko) "
                 "Version/11.0 Safari/604.1.38")]
 
+# Only build the parts of the pages that get scraped instead of the whole document tree
+CATALOG_STRAINER = SoupStrainer("li", class_="catalog-result")
+BOOK_PAGE_STRAINER = SoupStrainer(["dl", "div", "p", "table"],
+                                  class_=re.compile(r"\b(product-details|book-page|book-page-genre|chapter-download)\b"))
+
 # The "Browsing by Title" book catalog in page librivox.org
 TITLES_URL = "https://librivox.org/search/get_results?primary_key=0&search_category=title&search_order=alpha&project_type=either"
 
 
 def _get_scrape_headers():
-    random_ua = random.sample(USER_AGENTS, 1)[0]
-    headers = MAGIC_HEADERS
-    headers["User-Agent"] = random_ua
-    return headers
+    # A new dict per request since the headers are used from several threads at once
+    return {**MAGIC_HEADERS, "User-Agent": random.choice(USER_AGENTS)}
 
 
 def fetch_titles_from_page(page_number, get_books=True) -> ([Book], bool):
@@ -77,12 +96,18 @@ def fetch_titles_from_page(page_number, get_books=True) -> ([Book], bool):
 
     logger.debug(f"Fetching catalog page #{page_number}... ")
     url = TITLES_URL + f"&search_page={page_number}"
-    result = requests.get(url, headers=_get_scrape_headers())
+    session = download_session.get_session()
+    try:
+        result = session.get(url, headers=_get_scrape_headers(), timeout=70)
+    except download_session.get_download_exceptions() as e:
+        logger.error(f"Scraping timed out to fetch the catalog page #{page_number}")
+        logger.error(e)
+        return [], False
 
     if result.status_code != 200:
         return [], False
 
-    json_result = json.loads(result.text)
+    json_result = json_loads(result.content)
     if json_result["status"] != "SUCCESS":
         return [], False
 
@@ -92,20 +117,15 @@ def fetch_titles_from_page(page_number, get_books=True) -> ([Book], bool):
     books = []
     if get_books:
         html_results = json_result["results"]
-        scraper = BeautifulSoup(html_results, 'html.parser')
+        scraper = BeautifulSoup(html_results, HTML_PARSER, parse_only=CATALOG_STRAINER)
         catalog_results = scraper.find_all("li", class_="catalog-result")
 
         if catalog_results:
             for catalog_result in catalog_results:
                 book = Book()
                 result_data = catalog_result.find("div", class_="result-data")
-                book.title = result_data.a.text.strip()
                 # Remove enclosing " or ' if any
-                if book.title[0] is "\"" or book.title[0] is "'":
-                    book.title = book.title[1:]
-
-                if book.title[-1] is "\"" or book.title[-1] is "'":
-                    book.title = book.title[:-1]
+                book.title = result_data.a.text.strip().strip("\"'")
 
                 book.url = result_data.a.attrs["href"]
                 book_author = result_data.find(class_="book-author")
@@ -134,11 +154,37 @@ def fetch_titles_from_page(page_number, get_books=True) -> ([Book], bool):
     return books, True
 
 
+def _find_first_missing_page(page_number):
+    """Find the first catalog page from page_number onwards that can't be fetched.
+
+    Probes pages at exponentially growing distances and then binary searches between the last page
+    found and the first missing one, so only O(log n) pages are requested for n new pages.
+    """
+    if not fetch_titles_from_page(page_number, False)[1]:
+        return page_number
+
+    last_found = page_number
+    step = 1
+    while fetch_titles_from_page(last_found + step, False)[1]:
+        last_found += step
+        step *= 2
+    first_missing = last_found + step
+
+    while first_missing - last_found > 1:
+        middle = (last_found + first_missing) // 2
+        if fetch_titles_from_page(middle, False)[1]:
+            last_found = middle
+        else:
+            first_missing = middle
+
+    return first_missing
+
+
 def fetch_all_books(start_page=1, end_page=MAX_KNOWN_PAGE, need_update_page=False) -> [Book]:
     """Fetches metadata for all books from LibriVox's titles catalog.
 
     Scrapes {TITLES_URL} pages from start_page till end_page to obtain information of the available
-    books. It uses a process per page up to {NUM_PROCESSES} processes because the get request to
+    books. It uses a thread per page up to {NUM_THREADS} threads because the get request to
     each page can takea while to complete.
 
     Examples:
@@ -158,30 +204,20 @@ def fetch_all_books(start_page=1, end_page=MAX_KNOWN_PAGE, need_update_page=Fals
     assert start_page < end_page
     assert type(need_update_page) is bool
 
-    while need_update_page:
+    if need_update_page:
         logger.debug(f"Checking if the # of LibriVox catalog pages is larger than {end_page}...")
-        _, need_update_page = fetch_titles_from_page(end_page, False)
-        if need_update_page:
-            end_page += 1
-            logger.debug(f"Found new catalog page #{end_page}")
+        end_page = _find_first_missing_page(end_page)
+        logger.debug(f"Found catalog pages up to #{end_page - 1}")
 
     logger.info(f"Fetching LibriVox's book catalog from pages #{start_page} till #{end_page}...")
 
     all_books = []
-    """
-    # Commenting out multiprocess code for now as it crashes in Python 3.6.2 with the error:
+    # Threads instead of a process Pool, which crashed in Python 3.6.2 with the error:
     # "__NSPlaceholderDate initialize] may have been in progress in another thread when fork() was called."
-    fetched_titles = []
-    with Pool(NUM_PROCESSES) as pool:
-        fetched_titles = pool.map(fetch_titles_from_page, [n for n in range(start_page, end_page)])
-    for result in fetched_titles:
-        if result and result[1]:
-            all_books.extend(result[0])
-    """
-    for page_num in range(start_page, end_page):
-        catalog_page, could_fetch = fetch_titles_from_page(page_num)
-        if could_fetch and catalog_page:
-            all_books.extend(catalog_page)
+    with ThreadPoolExecutor(max_workers=NUM_THREADS) as executor:
+        for catalog_page, could_fetch in executor.map(fetch_titles_from_page, range(start_page, end_page)):
+            if could_fetch and catalog_page:
+                all_books.extend(catalog_page)
 
     return all_books
 
@@ -217,22 +253,43 @@ def _fetch_missing_book_metadata(book, scraper):
         logger.error(f"Scraping failed to find the \"genre, language, group\" details section of \"{book.url}\"")
 
 
+class _BookPageUnavailable(Exception):
+    """Raised when a book page doesn't download with a 200 status"""
+
+
+@functools.lru_cache(maxsize=BOOK_PAGE_CACHE_SIZE)
+def _download_book_page(url):
+    """Download a book page, raising _BookPageUnavailable if it couldn't be downloaded.
+
+    Only the page bytes of the last few books are memoized, parsed trees are many times larger.
+    Failures raise instead of returning so they are not cached and a later call can retry them.
+    """
+    book_page = download_session.get_session().get(url, headers=_get_scrape_headers(), timeout=70)
+    if book_page.status_code != 200:
+        raise _BookPageUnavailable(f"Got status code {book_page.status_code}")
+    return book_page.content
+
+
+def _get_book_scraper(url):
+    """Download and parse a book page, raising _BookPageUnavailable if it couldn't be downloaded."""
+    # librivox.org serves UTF-8, so skip the charset detection that book_page.text would do
+    return BeautifulSoup(_download_book_page(url), HTML_PARSER, parse_only=BOOK_PAGE_STRAINER,
+                         from_encoding="utf-8")
+
+
 def fetch_all_chapters(book) -> [Chapter]:
     """Fetch metadata for every chapter in the book."""
     logger.debug(f"Downloading info for chapters in book: \"{book.title[:70]}\"...")
-    session = download_session.make_session()
     try:
-        book_page = session.get(book.url, headers=_get_scrape_headers(), timeout=70)
+        scraper = _get_book_scraper(book.url)
     except download_session.get_download_exceptions() as e:
         logger.error(f"Scraping timed out to download chapters from book \"{book.url}\"")
         logger.error(e)
         return []
-
-    if book_page.status_code != 200:
-        logger.warn(f"Failed to download chapters information for book \"{book.url}\"")
+    except _BookPageUnavailable as e:
+        logger.warn(f"Failed to download chapters information for book \"{book.url}\": {e}")
         return []
 
-    scraper = BeautifulSoup(book_page.text, "html.parser")
     _fetch_missing_book_metadata(book, scraper)
 
     # Get the chapters information
@@ -247,13 +304,16 @@ def fetch_all_chapters(book) -> [Chapter]:
         logger.error(f"Scraping failed to find the chapters rows in the chapters table for book \"{book.url}\"")
         return chapters
 
-    num_row_elements = len(chapter_rows[0].find_all("td"))
+    # Search each row's cells once and reuse them for the column count check below. Cells are direct
+    # children of their row so there is no need to walk the links and text inside of them
+    rows_elements = [row.find_all("td", recursive=False) for row in chapter_rows]
+    num_row_elements = len(rows_elements[0])
     if num_row_elements == 7:
-        for row in chapter_rows:
+        for row, row_elements in zip(chapter_rows, rows_elements):
             chapter = Chapter(book)
-            chapter.title = row.find("a", class_="chapter-name").text
-            chapter.download_url = row.find("a", class_="chapter-name").attrs["href"]
-            row_elements = row.find_all("td")
+            chapter_anchor = row.find("a", class_="chapter-name")
+            chapter.title = chapter_anchor.text
+            chapter.download_url = chapter_anchor.attrs["href"]
             if not row_elements or not row_elements[0] or not row_elements[0].a:
                 logger.error(f"Scraping failed for chapter metadata of book \"{book.url}\"")
                 break
@@ -261,18 +321,21 @@ def fetch_all_chapters(book) -> [Chapter]:
             chapter.number = int(row_elements[0].text.replace(row_elements[0].a.text, "").strip())
             if len(row_elements) > 2:
                 chapter.author = row_elements[2].text.strip()
-                if row_elements[2].a:
-                    chapter.author_url = row_elements[2].a.attrs["href"]
+                author_anchor = row_elements[2].a
+                if author_anchor:
+                    chapter.author_url = author_anchor.attrs["href"]
 
                 if len(row_elements) > 3:
                     chapter.source_text = row_elements[3].text.strip()
-                    if row_elements[3].a:
-                        chapter.source_text_url = row_elements[3].a.attrs["href"]
+                    source_text_anchor = row_elements[3].a
+                    if source_text_anchor:
+                        chapter.source_text_url = source_text_anchor.attrs["href"]
 
                 if len(row_elements) > 4:
                     chapter.reader_name = row_elements[4].text.strip()
-                    if row_elements[4].a:
-                        chapter.reader_url = row_elements[4].a.attrs["href"]
+                    reader_anchor = row_elements[4].a
+                    if reader_anchor:
+                        chapter.reader_url = reader_anchor.attrs["href"]
 
                 if len(row_elements) > 5:
                     chapter.duration = row_elements[5].text.strip()
@@ -291,11 +354,11 @@ def fetch_all_chapters(book) -> [Chapter]:
                 logger.error(f"Scraping failed for chapter metadata of book \"{book.url}\"")
 
     elif num_row_elements == 4:
-        for row in chapter_rows:
+        for row, row_elements in zip(chapter_rows, rows_elements):
             chapter = Chapter(book)
-            chapter.title = row.find("a", class_="chapter-name").text
-            chapter.download_url = row.find("a", class_="chapter-name").attrs["href"]
-            row_elements = row.find_all("td")
+            chapter_anchor = row.find("a", class_="chapter-name")
+            chapter.title = chapter_anchor.text
+            chapter.download_url = chapter_anchor.attrs["href"]
             if not row_elements or not row_elements[0] or not row_elements[0].a:
                 logger.error(f"Scraping failed for chapter metadata of book \"{book.url}\"")
                 break
@@ -304,8 +367,9 @@ def fetch_all_chapters(book) -> [Chapter]:
             if len(row_elements) > 2:
                 chapter.reader_name = row_elements[2].text.strip()
                 # Chapters read by a group of people don't have a link to the reader's profile
-                if row_elements[2].a:
-                    chapter.reader_url = row_elements[2].a.attrs["href"]
+                reader_anchor = row_elements[2].a
+                if reader_anchor:
+                    chapter.reader_url = reader_anchor.attrs["href"]
 
                 if len(row_elements) > 3:
                     chapter.duration = row_elements[3].text.strip()
@@ -325,17 +389,9 @@ def fetch_all_chapters(book) -> [Chapter]:
 
 def fetch_all_books_chapters(books):
     """Fetches metadata for all chapters in the received books."""
-    """
-    # Commenting out multiprocess code for now as it crashes in Python 3.6.2 with the error:
-    # "__NSPlaceholderDate initialize] may have been in progress in another thread when fork() was called."
-    with Pool(NUM_PROCESSES) as pool:
-        lists_of_chapters = pool.map(fetch_all_chapters, books)
-
-    for booky, chapters in zip(books, lists_of_chapters):
-        booky.chapters = chapters
-    """
-    for book_to_fetch in books:
-        book_to_fetch.chapters = fetch_all_chapters(book_to_fetch)
+    with ThreadPoolExecutor(max_workers=NUM_THREADS) as executor:
+        for book_to_fetch, chapters in zip(books, executor.map(fetch_all_chapters, books)):
+            book_to_fetch.chapters = chapters
 
 
 def download_chapter(target_chapter):
@@ -3,22 +3,20 @@ from requests.exceptions import ConnectionError
 from urllib3.exceptions import ReadTimeoutError
 
 import requests
+import threading
 
-MAX_RETRIES = 17
-BACKOFF_FACTOR = 0.2  # Sleep for [0.0s, 0.4s, 0.6s, ...] between retries
+MAX_RETRIES = 8
+BACKOFF_FACTOR = 0.5  # Sleep for [0s, 1s, 2s, 4s, ...] between retries
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]  # Only retry on these status_codes
 POOL_CONNECTIONS = 20
 POOL_MAX_SIZE = 50
 
+_thread_local = threading.local()
+
 
 def make_session():
     session = requests.Session()
-    retry_policy = Retry(total=MAX_RETRIES,
-                         backoff_factor=BACKOFF_FACTOR,
-                         status_forcelist=[500, 502, 503, 504])  # Only retry on these status_codes
-
-    http_adapter = requests.adapters.HTTPAdapter(pool_connections=POOL_CONNECTIONS,
-                                                 pool_maxsize=POOL_MAX_SIZE,
-                                                 max_retries=retry_policy)
+    http_adapter = requests.adapters.HTTPAdapter(**get_http_parameters())
 
     session.mount("http://", http_adapter)
     session.mount("https://", http_adapter)
@@ -26,10 +24,27 @@ def make_session():
     return session
 
 
+def get_session():
+    """Return a session shared by every request made from the calling thread.
+
+    Reusing it keeps the connections to the server alive between downloads instead of
+    paying a new TCP and TLS handshake for each one.
+    """
+    session = getattr(_thread_local, "session", None)
+    if session is None:
+        session = make_session()
+        _thread_local.session = session
+    return session
+
+
 def get_http_parameters():
+    # Wait as long as the server asks to on 429/503 responses, and hand back the last response
+    # instead of raising once the retries run out so callers can check its status_code
     retry_policy = Retry(total=MAX_RETRIES,
                          backoff_factor=BACKOFF_FACTOR,
-                         status_forcelist=[500, 502, 503, 504])  # Only retry on these status_codes
+                         status_forcelist=RETRY_STATUS_CODES,
+                         respect_retry_after_header=True,
+                         raise_on_status=False)
 
     return {"pool_connections": POOL_CONNECTIONS, "pool_maxsize": POOL_MAX_SIZE,
             "max_retries": retry_policy}
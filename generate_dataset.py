@@ -1,6 +1,8 @@
 """Generate a Clean Speech/Noise dataset"""
-from multiprocessing import Pool
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 import os
+import random
 
 import download_internetarchive
 import download_librivox
@@ -10,11 +12,21 @@ import pre_process_files
 logger = logging_setup.setup_logger("Dataset Generator")
 
 CLEAN_DIRTY_SPLIT = .5  # What % of our data will be clean speech speech
-NUM_PROCESSES = 1
+NUM_THREADS = 16  # Number of chapters downloaded concurrently
 NUM_LANGUAGES = 30
 CHAPTERS_PER_LANGUAGE = 15
 
 
+def _iter_fetched_chapters(books):
+    """Yield the books after fetching their chapters, NUM_THREADS books at a time."""
+    with ThreadPoolExecutor(max_workers=NUM_THREADS) as executor:
+        for batch_start in range(0, len(books), NUM_THREADS):
+            batch = books[batch_start:batch_start + NUM_THREADS]
+            for book, chapters in zip(batch, executor.map(download_librivox.fetch_all_chapters, batch)):
+                book.chapters = chapters
+                yield book
+
+
 def download_clean_speech_files(download_dir):
     logger.info(f"Downloading clean speech files to {download_dir}")
     if not os.path.exists(download_dir):
@@ -24,43 +36,40 @@ def download_clean_speech_files(download_dir):
     logger.info(f"Downloaded information for {len(books)} books from LibriVox")
     for book in books:
         book.download_dir = download_dir
-    download_librivox.fetch_all_books_chapters(books)
-    readers = set()
-    languages = {}
-    chapter_count = 0
-    for book in books:
-        for chapter in book.chapters:
-            if chapter.language_code in languages:
-                languages[chapter.language_code].append(chapter)
-            else:
-                languages[chapter.language_code] = [chapter]
-            chapter_count += 1
+    # Visit the books in random order to not favor the ones early in the catalog
+    random.shuffle(books)
 
-    logger.info(f"Downloaded information for {chapter_count} chapters in {len(languages.keys())} languages")
+    chapter_count = 0
+    max_chapters = NUM_LANGUAGES * CHAPTERS_PER_LANGUAGE
+    readers = set()
+    chapters_per_language = Counter()
     chapters_to_download = []
-    # Get at most NUM_LANGUAGES chapter recordings from different speakers
-    for idx, language in enumerate(languages.keys()):
-        if idx >= NUM_LANGUAGES:
+    # Get at most CHAPTERS_PER_LANGUAGE chapter recordings from different speakers in each of the
+    # first NUM_LANGUAGES languages found. Chapters are only fetched until these quotas are filled
+    for book in _iter_fetched_chapters(books):
+        if len(chapters_to_download) >= max_chapters:
             break
-        chaps_per_lang = 0
-        for chapter in languages[language]:
-            if chaps_per_lang >= CHAPTERS_PER_LANGUAGE:
-                break
+        chapter_count += len(book.chapters)
+        for chapter in book.chapters:
+            language = chapter.language_code
+            if language not in chapters_per_language and len(chapters_per_language) >= NUM_LANGUAGES:
+                continue
+            if chapters_per_language[language] >= CHAPTERS_PER_LANGUAGE:
+                continue
 
             # Don't get multiple files from the same reader
             if chapter.reader_name not in readers:
-                chaps_per_lang += 1
+                chapters_per_language[language] += 1
                 readers.add(chapter.reader_name)
                 chapters_to_download.append(chapter)
 
-    """
-    # Commenting out multiprocess code for now as it crashes in Python 3.6.2 with the error:
+    logger.info(f"Selected {len(chapters_to_download)} out of {chapter_count} chapters "
+                f"in {len(chapters_per_language)} languages")
+
+    # Threads instead of a process Pool, which crashed in Python 3.6.2 with the error:
     # "__NSPlaceholderDate initialize] may have been in progress in another thread when fork() was called."
-    with Pool(NUM_PROCESSES) as pool:
-        pool.map(download_librivox.download_chapter, chapters_to_download)
-    """
-    for chapter in chapters_to_download:
-        chapter.download()
+    with ThreadPoolExecutor(max_workers=NUM_THREADS) as executor:
+        list(executor.map(download_librivox.download_chapter, chapters_to_download))
 
 
 def download_noise_files(download_dir):
@@ -1,11 +1,6 @@
 import coloredlogs, logging
 
 
-LEVEL_TO_STRING = {logging.DEBUG: "DEBUG", logging.INFO: "INFO",
-                   logging.WARN: "WARN", logging.ERROR: "ERROR",
-                   logging.CRITICAL: "CRITICAL"}
-
-
 def setup_logger(name, log_filename=None, log_level=logging.DEBUG):
     """Setup a logger with the specified name and file.
     If a log_filename is specified, the logger will also output logs to that
@@ -15,7 +10,7 @@ def setup_logger(name, log_filename=None, log_level=logging.DEBUG):
     logger = logging.getLogger(name)
     logger.setLevel(log_level)
     coloredlogs.install(fmt=FORMAT, datefmt="%H:%M:%S",
-                        level=LEVEL_TO_STRING[log_level], logger=logger)
+                        level=log_level, logger=logger)
 
     if log_filename:
         formatter = logging.Formatter(FORMAT)
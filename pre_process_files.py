@@ -6,192 +6,307 @@ Preprocess Module
 - TODO: Trims files that are too long
 - TODO: Trim beginning and end of files
 - Augments dataset by generating combinations of speech noise
+- Packs the processed files into float32 binary blobs for training
 """
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import os
+import queue
 import random
 import scipy.io.wavfile as wav
 import shutil
+import struct
 import subprocess
 
 import logging_setup
 
 logger = logging_setup.setup_logger("Preprocess Module")
 
-THREADS = 4
+THREADS = 1  # Threads used by each ffmpeg process, files are processed in parallel instead
+# Cores this process may run on, or None where they can't be queried or pinned (macOS)
+CORES = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else None
+NUM_WORKERS = len(CORES) if CORES else os.cpu_count() or 1  # Number of ffmpeg processes running at once
+NICE_LEVEL = 5  # Niceness added to the ffmpeg processes so they don't starve the rest of the host
+NICE_COMMAND = shutil.which("nice")
+TASKSET_COMMAND = shutil.which("taskset")
 NUM_AUGMENT = 20  # The number of files to generate by augmenting the noise with clean audio
 SAMPLE_RATE = 44100
+LOUDNESS_FILTER = "loudnorm=I=-16:TP=-1.5:LRA=11"  # EBU R128 volume normalization
+INT16_SCALE = np.float32(1 / 32767.0)
 VALID_AUDIO = ["mp3", "aac", "mp4", "ogg", "wav", "opus"]
 
 
-def format_int(number):
-    assert type(number) is int
-    global prefix_size
-    return f"{number:0{prefix_size}d}"
+def format_int(number, width):
+    return f"{number:0{width}d}"
 
 
 def is_audio_file(file_name):
     return file_name.split(".")[-1].lower() in VALID_AUDIO
 
 
+def list_audio_files(dir_path):
+    """List the names of the audio files in a directory, scanning it only once"""
+    return [entry.name for entry in os.scandir(dir_path) if entry.is_file() and is_audio_file(entry.name)]
+
+
 def make_dir(dir_path):
-    if os.path.exists(dir_path) and os.path.isdir(dir_path):
-        return
-    elif not os.path.exists(dir_path):
-        os.mkdir(dir_path)
-    else:
+    try:
+        os.makedirs(dir_path, exist_ok=True)
+    except FileExistsError:
         raise Exception(f"\"{dir_path}\" exists but is not a directory")
 
 
-def set_prefix_size(clean_dir, dirty_dir):
-    """Set the prefix size according to the maximum # of files"""
-    num_clean = len(os.listdir(clean_dir))
-    num_dirty = len(os.listdir(dirty_dir))
+def make_pinned_command(command, core):
+    """Prefix a command with nice and taskset so they apply before ffmpeg starts any of its threads"""
+    prefix = []
+    if NICE_COMMAND:
+        prefix += [NICE_COMMAND, "-n", str(NICE_LEVEL)]
+    if TASKSET_COMMAND and core is not None:
+        prefix += [TASKSET_COMMAND, "-c", str(core)]
+    return prefix + command
+
+
+def renice(process, command):
+    """Lower the priority of a running process, leaving it running as is if that isn't possible"""
+    try:
+        os.setpriority(os.PRIO_PROCESS, process.pid, os.getpriority(os.PRIO_PROCESS, 0) + NICE_LEVEL)
+    except ProcessLookupError:
+        pass  # The process already finished
+    except OSError as e:
+        logger.warning(f"Failed to lower the priority of \"{command[0]}\": {e}")
+
+
+def run_pinned(command, free_cores):
+    """Run a command as a lower priority subprocess pinned to a core no other worker is using"""
+    core = free_cores.get()
+    try:
+        # Exiting the with block waits on the process even if something fails while it runs. Concurrent
+        # ffmpeg processes must not read the terminal, they would fight over it and could leave echo disabled
+        with subprocess.Popen(make_pinned_command(command, core), stdin=subprocess.DEVNULL) as process:
+            if not NICE_COMMAND:
+                # Only reaches the threads ffmpeg starts from now on, preexec_fn is not safe to use from threads
+                renice(process, command)
+    finally:
+        free_cores.put(core)
+    return process.returncode
+
+
+def run_in_parallel(commands):
+    """Run the commands as subprocesses, up to NUM_WORKERS of them at once, returning their exit codes."""
+    free_cores = queue.Queue()
+    for worker in range(NUM_WORKERS):
+        free_cores.put(CORES[worker % len(CORES)] if CORES else None)  # Only shared if NUM_WORKERS is raised
+    # Threads are enough as they only wait on the subprocesses
+    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
+        return list(executor.map(run_pinned, commands, [free_cores] * len(commands)))
+
+
+def get_prefix_size(clean_files, dirty_files):
+    """Get the prefix size according to the maximum # of files"""
+    num_clean = len(clean_files)
+    num_dirty = len(dirty_files)
     num_dirty += min(NUM_AUGMENT, num_clean, num_dirty)
-    global prefix_size
-    prefix_size = len(str(max(num_clean, num_dirty)))
+    return len(str(max(num_clean, num_dirty)))
 
 
-def merge_channels(in_dir, out_dir):
-    """Merge stereo channels into mono channels and normalize the sampling rate"""
-    logger.info("Merging audio channels into mono...")
-    make_dir(out_dir)
-    files = os.listdir(in_dir)
+def process_audio_files(in_dir, out_dir, prefix_size, files=None):
+    """Convert audio files into mono wav files with a normalized sampling rate and volume level
+
+    Everything is done in a single ffmpeg pass per file so each file is only decoded and encoded once.
+    Output names are prefixed with the file index zero padded to prefix_size digits.
+    The audio files in in_dir are listed unless they are already known and passed in files.
+    out_dir must already exist.
+    """
+    logger.info(f"Processing audio files in \"{in_dir}\"...")
+    audio_filter = f"[0:a]aformat=channel_layouts=mono,{LOUDNESS_FILTER},aresample={SAMPLE_RATE}[a]"
+    if files is None:
+        files = list_audio_files(in_dir)
+    commands = []
+    out_paths = []
     for idx, file in enumerate(files):
-        if is_audio_file(file):
-            logger.debug(f"Merging audio channels in file \"{file}\"...")
-            in_path = os.path.join(in_dir, file)
-            file_name = format_int(idx) + "_" + "".join(file.split(".")[:-1]) + ".wav"
-            file_name = file_name.replace(" ", "_")
-            file_name = file_name.replace("-_", "_")
-            out_path = os.path.join(out_dir, file_name)
-            subprocess.run(["ffmpeg",
-                            "-i", in_path,
-                            "-loglevel", "panic",
-                            "-ac", "1",  # Merge into 1 mono channel
-                            "-ar", str(SAMPLE_RATE),
-                            "-threads", str(THREADS),
-                            out_path])
-    logger.info("Finished merging audio channels into mono")
-
-
-def normalize_volume(in_dir, out_dir):
-    """Normalize the audio volume levels"""
-    logger.info("Normalizing volume levels...")
-    make_dir(out_dir)
-    for idx, file in enumerate(os.listdir(in_dir)):
-        logger.debug(f"Normalizing volume level of file \"{file}\"...")
+        logger.debug("Processing audio file \"%s\"...", file)  # Only formatted if DEBUG is enabled
         in_path = os.path.join(in_dir, file)
-        subprocess.run(["ffmpeg-normalize",
-                        in_path,
-                        "--merge",
-                        "--dir",
-                        "-t", ".1",
-                        "--acodec", "pcm_s16le"])
-
-    out_temp = os.path.join(in_dir, "normalized")
-    logger.debug(f"Moving files from \"{out_temp}\" into \"{out_dir}\"...")
-    for file in os.listdir(out_temp):
-        destination_path = os.path.join(out_dir, file)
-        shutil.move(os.path.join(out_temp, file), destination_path)
-    shutil.rmtree(out_temp)
-
-    logger.info("Finished normalizing volume levels")
-
-
-def augment_dirty_dir(clean_dir, dirty_dir, out_dir):
+        file_name = format_int(idx, prefix_size) + "_" + "".join(file.split(".")[:-1]) + ".wav"
+        file_name = file_name.replace(" ", "_")
+        file_name = file_name.replace("-_", "_")
+        out_path = os.path.join(out_dir, file_name)
+        commands.append(["ffmpeg",
+                         "-y",  # Overwrite outputs left by earlier runs instead of prompting for it
+                         "-i", in_path,
+                         "-loglevel", "panic",
+                         "-filter_complex", audio_filter,
+                         "-map", "[a]",
+                         "-ac", "1",  # Merge into 1 mono channel
+                         "-ar", str(SAMPLE_RATE),
+                         "-acodec", "pcm_s16le",
+                         "-threads", str(THREADS),
+                         out_path])
+        out_paths.append(out_path)
+    for out_path, return_code in zip(out_paths, run_in_parallel(commands)):
+        if return_code != 0:
+            logger.error(f"Failed to process audio file into \"{out_path}\"")
+    logger.info(f"Finished processing audio files in \"{in_dir}\"")
+
+
+def make_merge_command(merges):
+    """Build a single ffmpeg command that mixes every (clean_path, dirty_path, merged_path) in merges"""
+    command = ["ffmpeg", "-loglevel", "panic"]  # Make ffmpeg shut up
+    command += ["-y"]  # Overwrite outputs left by a failed shard or an earlier run instead of prompting for it
+    filters = []
+    outputs = []
+    for idx, (clean_path, dirty_path, merged_path) in enumerate(merges):
+        command += ["-i", clean_path, "-i", dirty_path]
+        filters.append(f"[{2 * idx}:a][{2 * idx + 1}:a]amerge[merged{idx}]")
+        outputs += ["-map", f"[merged{idx}]",
+                    "-threads", str(THREADS),
+                    "-ac", "1",  # Output a mono channel
+                    merged_path]
+    return command + ["-filter_complex", ";".join(filters)] + outputs
+
+
+def augment_dirty_dir(clean_dir, dirty_dir, out_dir, prefix_size, clean_files=None, dirty_files=None):
     """Augment the dirty examples by mixing clean speech with noise
     If the files being merged have a different length, the duration of the shortest
     file will be used and the other one will be cropped.
+    The audio files in clean_dir and dirty_dir are listed unless they are passed in.
+    out_dir must already exist.
     """
-    num_augment = min(len(os.listdir(clean_dir)), len(os.listdir(dirty_dir)), NUM_AUGMENT)
+    if clean_files is None:
+        clean_files = list_audio_files(clean_dir)
+    if dirty_files is None:
+        dirty_files = list_audio_files(dirty_dir)
+    num_augment = min(len(clean_files), len(dirty_files), NUM_AUGMENT)
     # Combine num_augment random clean files and num_augment random dirty files
     logger.info(f"Augmenting dirty files dataset files by {num_augment} files...")
-    make_dir(out_dir)
-    clean_files = random.sample(os.listdir(clean_dir), num_augment)
-    dirty_files = random.sample(os.listdir(dirty_dir), num_augment)
-    for idx, (clean, dirty) in enumerate(zip(clean_files, dirty_files)):
-        if is_audio_file(clean) and is_audio_file(dirty):
-            clean_path = os.path.join(clean_dir, clean)
-            dirty_path = os.path.join(dirty_dir, dirty)
-            merged_name = format_int(idx) + "_" + clean[:5] + dirty[:5] + "_aug.wav"
-            merged_path = os.path.join(out_dir, merged_name)
-
-            logger.debug(f"Merging files \"{clean}\" and \"{dirty}\" into \"{merged_name}\"...")
-            subprocess.run(["ffmpeg",
-                            "-loglevel", "panic",  # Make ffmpeg shut up
-                            "-i", clean_path,
-                            "-i", dirty_path,
-                            "-filter_complex", "amerge",
-                            "-threads", str(THREADS),
-                            "-ac", "1",  # Output a mono channel
-                            merged_path])
-        else:
-            logger.warn(f"Both \"{clean}\" and \"{dirty}\" should be audiofiles. Skipping them...")
+    clean_sample = random.sample(clean_files, num_augment)
+    dirty_sample = random.sample(dirty_files, num_augment)
+    merges = []
+    for idx, (clean, dirty) in enumerate(zip(clean_sample, dirty_sample)):
+        clean_path = os.path.join(clean_dir, clean)
+        dirty_path = os.path.join(dirty_dir, dirty)
+        merged_name = format_int(idx, prefix_size) + "_" + clean[:5] + dirty[:5] + "_aug.wav"
+        merged_path = os.path.join(out_dir, merged_name)
+
+        logger.debug("Merging files \"%s\" and \"%s\" into \"%s\"...", clean, dirty, merged_name)
+        merges.append((clean_path, dirty_path, merged_path))
+
+    # Spread the merges over one ffmpeg process per worker instead of starting one per merge
+    shards = [merges[worker::NUM_WORKERS] for worker in range(NUM_WORKERS)]
+    shards = [shard for shard in shards if shard]
+    return_codes = run_in_parallel([make_merge_command(shard) for shard in shards])
+
+    # A single bad input fails every merge in its shard, so merge the pairs of failed shards one at a time
+    retries = []
+    for shard, return_code in zip(shards, return_codes):
+        if return_code != 0:
+            logger.error(f"Failed to merge a shard of {len(shard)} files, merging them one at a time")
+            retries += shard
+    return_codes = run_in_parallel([make_merge_command([merge]) for merge in retries])
+    for (clean_path, dirty_path, merged_path), return_code in zip(retries, return_codes):
+        if return_code != 0:
+            logger.error(f"Failed to merge files \"{clean_path}\" and \"{dirty_path}\"")
 
     logger.info(f"Finished augmenting dirty files")
 
 
 def read_wav_as_np(filename):
     data = wav.read(filename)
-    np_arr = data[1].astype("float32") / 32767.0  # Normalize 16-bit format into a [-1, 1] range
-    # np_arr = np.array(np_arr)
+    # Normalize 16-bit format into a [-1, 1] range, converting and scaling in a single pass
+    np_arr = np.multiply(data[1], INT16_SCALE, dtype=np.float32)
     return np_arr, data[0]
 
 
 def convert_np_audio_to_sample_blocks(song_np, block_size):
-    block_lists = []
-    total_samples = song_np.shape[0]
-    num_samples_so_far = 0
-    while(num_samples_so_far < total_samples):
-        block = song_np[num_samples_so_far:num_samples_so_far+block_size]
-        if(block.shape[0] < block_size):
-            padding = np.zeros((block_size - block.shape[0],))
-            block = np.concatenate((block, padding))
-        block_lists.append(block)
-        num_samples_so_far += block_size
-    return block_lists
+    """Split the samples into rows of block_size, zero padding the last one"""
+    padding = (-song_np.shape[0]) % block_size
+    if padding:
+        song_np = np.concatenate((song_np, np.zeros(padding, dtype=song_np.dtype)))
+    return song_np.reshape(-1, block_size)
 
 
 def load_training_example(filename, block_size=2048):
     data, bitrate = read_wav_as_np(filename)
     X = convert_np_audio_to_sample_blocks(data, block_size)
-    Y = X[1:]
-    Y.append(np.zeros(block_size))  # Add special end block composed of all zeros
+    Y = np.vstack((X[1:], np.zeros((1, block_size), dtype=X.dtype)))  # Add special end block composed of all zeros
     return X, Y
 
 
-def make_dataset_blob(clean_files, dirty_files):
+def count_sample_blocks(filename, block_size):
+    """Count the sample blocks in a wav file by memory mapping it instead of reading the samples"""
+    num_samples = wav.read(filename, mmap=True)[1].shape[0]
+    return -(-num_samples // block_size)
 
-    for file in clean_files:
-        pass
+
+def write_blob(files, blob_path, block_size):
+    """Write the sample blocks of every file into a contiguous (num_blocks, block_size) float32 blob
+
+    The block offset where each file starts, plus the total block count at the end, is saved next to the blob
+    in blob_path + ".offsets.npy". Files that can't be read are skipped.
+    """
+    readable_files = []
+    counts = []
+    for file in files:
+        try:
+            counts.append(count_sample_blocks(file, block_size))
+        except (OSError, ValueError, struct.error) as e:  # Missing, empty or truncated files
+            logger.error(f"Skipping unreadable file \"{file}\": {e}")
+            continue
+        readable_files.append(file)
+    files = readable_files
+    offsets = np.cumsum([0] + counts)
+    np.save(blob_path + ".offsets.npy", offsets)
+    blob = np.memmap(blob_path, dtype=np.float32, mode="w+", shape=(int(offsets[-1]), block_size))
+
+    def load_blocks(filename):
+        return convert_np_audio_to_sample_blocks(read_wav_as_np(filename)[0], block_size)
+
+    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
+        # Load at most NUM_WORKERS files ahead so memory use doesn't grow with the dataset
+        for start in range(0, len(files), NUM_WORKERS):
+            batch = files[start:start + NUM_WORKERS]
+            for offset, blocks in zip(offsets[start:], executor.map(load_blocks, batch)):
+                blob[offset:offset + blocks.shape[0]] = blocks
+    blob.flush()
+    logger.info(f"Wrote {offsets[-1]} sample blocks from {len(files)} files into \"{blob_path}\"")
+
+
+def make_dataset_blob(clean_files, dirty_files, out_dir, block_size=2048):
+    """Pack the processed clean and dirty wav files into one float32 binary file each
+
+    The blobs can be loaded with np.memmap(path, dtype=np.float32, mode="r").reshape(-1, block_size)
+    The blocks of file i are blob[offsets[i]:offsets[i + 1]] with offsets = np.load(path + ".offsets.npy"),
+    so blocks can be paired with the next one within each file like load_training_example does.
+    """
+    logger.info(f"Making dataset blobs...")
+    write_blob(clean_files, os.path.join(out_dir, "clean.f32"), block_size)
+    write_blob(dirty_files, os.path.join(out_dir, "dirty.f32"), block_size)
+    logger.info(f"Finished making dataset blobs")
 
 
 def pre_process(clean_dir, dirty_dir, out_dir):
     # Combine a subset of clean and dirty files to create more dirty examples
     logger.info(f"Pre-processing dataset files...")
-    set_prefix_size(clean_dir, dirty_dir)  # Files start with 001, 002, etc to avoid duplicate names
+    # List each directory once and share the listings between the stages
+    clean_files = list_audio_files(clean_dir)
+    dirty_files = list_audio_files(dirty_dir)
+    prefix_size = get_prefix_size(clean_files, dirty_files)  # Files start with 001, 002, etc to avoid duplicate names
     augmented_dir = os.path.join(dirty_dir, "augmented")
-    augment_dirty_dir(clean_dir, dirty_dir, augmented_dir)
-
-    # Merge stereo channels, convert audiofiles to wav and set the sampling rate to 41000
-    temp_clean_mono = os.path.join(out_dir, "clean_mono")
-    temp_dirty_mono = os.path.join(out_dir, "dirty_mono")
-
-    merge_channels(clean_dir, temp_clean_mono)
-    merge_channels(dirty_dir, temp_dirty_mono)
-    merge_channels(augmented_dir, temp_dirty_mono)
-
-    # Normalize the volume levels
     processed_clean = os.path.join(out_dir, "clean_processed")
     processed_dirty = os.path.join(out_dir, "dirty_processed")
-
-    normalize_volume(temp_clean_mono, processed_clean)
-    normalize_volume(temp_dirty_mono, processed_dirty)
-    shutil.rmtree(temp_clean_mono)
-    shutil.rmtree(temp_dirty_mono)
-
-    # make_dataset_blob(processed_clean, processed_dirty)
-
-    # TODO: Make big binary file of allprocessing files
+    # Create every output directory once before any work is dispatched
+    for dir_path in (augmented_dir, processed_clean, processed_dirty):
+        make_dir(dir_path)
+    augment_dirty_dir(clean_dir, dirty_dir, augmented_dir, prefix_size, clean_files, dirty_files)
+
+    # Merge stereo channels, convert audiofiles to wav, set the sampling rate to 44100 and
+    # normalize the volume levels
+    process_audio_files(clean_dir, processed_clean, prefix_size, clean_files)
+    process_audio_files(dirty_dir, processed_dirty, prefix_size, dirty_files)
+    process_audio_files(augmented_dir, processed_dirty, prefix_size)
+
+    # Make a big binary file of all the processed files for training
+    make_dataset_blob([os.path.join(processed_clean, file) for file in list_audio_files(processed_clean)],
+                      [os.path.join(processed_dirty, file) for file in list_audio_files(processed_dirty)],
+                      out_dir)
     logger.info(f"Finished pre-processing dataset files")